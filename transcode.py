@@ -2,20 +2,42 @@
 import os
 import re
 import sys
-import pipes
 import errno
 import shlex
 import cli_ui
 import shutil
 import signal
 import argparse
+import threading
 import subprocess
 import mutagen.flac
 import multiprocessing
+import concurrent.futures
 from rich.console import Console
 
 import tagging
 
+# Optional in-process MP3 path: decode with libsndfile (soundfile) and
+# encode with the LAME bindings (lameenc) instead of forking a
+# flac | lame pipeline per file. When either module is missing we fall
+# back to the subprocess pipeline.
+try:
+    import numpy
+    import soundfile
+    import lameenc
+except ImportError:
+    numpy = None
+    soundfile = None
+    lameenc = None
+
+# soxr wraps the same resampler sox's rate filter uses; with it the
+# resampled MP3 path stays in-process too instead of going through a
+# sox | lame pipeline.
+try:
+    import soxr
+except ImportError:
+    soxr = None
+
 console = Console()
 
 encoders = {
@@ -25,6 +47,11 @@ encoders = {
     'FLAC': {'enc': 'flac', 'ext': '.flac', 'opts': '--best'}
 }
 
+# Filename/directory sanitization, compiled once; both run per
+# file/release.
+_SANITIZE_FILE = re.compile(r'[\?<>\\*\|"]')
+_SANITIZE_DIR = str.maketrans('', '', '\\/:*?"<>|')
+
 class TranscodeException(Exception):
     pass
 
@@ -39,139 +66,212 @@ class UnknownSampleRateException(TranscodeException):
 # pipeline fails, not just the last one.
 #
 # This function constructs a pipeline of processes from a chain of
-# commands just like a shell does, but it returns the status code (and
-# stderr) of every process in the pipeline, not just the last one. The
-# results are returned as a list of (code, stderr) pairs, one pair per
-# process.
+# commands (one argv list per command) just like a shell does, but it
+# returns the status code (and stderr) of every process in the
+# pipeline, not just the last one. The results are returned as a list
+# of (code, stderr) pairs, one pair per process.
 def run_pipeline(cmds):
-    # The Python executable (and its children) ignore SIGPIPE. (See
-    # http://bugs.python.org/issue1652) Our subprocesses need to see
-    # it.
-    sigpipe_handler = signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    # The Python executable ignores SIGPIPE (see
+    # http://bugs.python.org/issue1652), but our subprocesses need to
+    # see it. Popen's restore_signals (on by default on POSIX) resets
+    # SIGPIPE to SIG_DFL in each child, so there is no need to swap the
+    # handler process-wide -- which also raced against concurrent pool
+    # workers spawning their own pipelines.
     stdin = None
     last_proc = None
     procs = []
-    try:
-        for cmd in cmds:
-            proc = subprocess.Popen(shlex.split(cmd), stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if last_proc:
-                # Ensure last_proc receives SIGPIPE if proc exits first
-                last_proc.stdout.close()
-            procs.append(proc)
-            stdin = proc.stdout
-            last_proc = proc
-    finally:
-        signal.signal(signal.SIGPIPE, sigpipe_handler)
+    for cmd in cmds:
+        proc = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=-1)
+        if last_proc:
+            # Ensure last_proc receives SIGPIPE if proc exits first
+            last_proc.stdout.close()
+        procs.append(proc)
+        stdin = proc.stdout
+        last_proc = proc
+
+    # Drain each intermediate process's stderr from a thread. Waiting
+    # for a process whose stderr PIPE has filled up deadlocks, and lame
+    # can easily write more than a pipe buffer's worth of warnings.
+    def drain_stderr(proc, buf):
+        buf += proc.stderr.read()
+        proc.stderr.close()
+
+    drains = []
+    for proc in procs[:-1]:
+        buf = bytearray()
+        thread = threading.Thread(target=drain_stderr, args=(proc, buf))
+        thread.start()
+        drains.append((thread, buf))
 
     last_stderr = last_proc.communicate()[1]
+    for (thread, buf) in drains:
+        thread.join()
 
     results = []
-    for (cmd, proc) in zip(cmds[:-1], procs[:-1]):
-        # wait() is OK here, despite use of PIPE above; these procs
-        # are finished.
+    for (proc, (thread, buf)) in zip(procs[:-1], drains):
+        # wait() is OK here; stderr has been drained, so these procs
+        # cannot block on a full pipe.
         proc.wait()
-        results.append((proc.returncode, proc.stderr.read()))
+        results.append((proc.returncode, bytes(buf)))
     results.append((last_proc.returncode, last_stderr))
     return results
 
 def locate(root, match_function, ignore_dotfiles=True):
     '''
-    Yields all filenames within the root directory for which match_function returns True.
+    Yields all filenames within the root directory for which
+    match_function returns True. Built on os.scandir, so each entry's
+    name and type come straight from the directory read with no extra
+    stat or path join per file.
     '''
-    for path, dirs, files in os.walk(root):
-        for filename in (os.path.abspath(os.path.join(path, filename)) for filename in files if match_function(filename)):
-            if ignore_dotfiles and os.path.basename(filename).startswith('.'):
-                pass
-            else:
-                yield filename
+    root = os.path.abspath(root)
+    subdirs = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                # like os.walk: list symlinked dirs but don't descend
+                if not entry.is_symlink():
+                    subdirs.append(entry.path)
+            elif match_function(entry.name):
+                if ignore_dotfiles and entry.name.startswith('.'):
+                    pass
+                else:
+                    yield entry.path
+    for subdir in subdirs:
+        yield from locate(subdir, match_function, ignore_dotfiles)
 
 def ext_matcher(*extensions):
     '''
     Returns a function which checks if a filename has one of the specified extensions.
     '''
-    return lambda f: os.path.splitext(f)[-1].lower() in extensions
+    exts = tuple(ext.lower() for ext in extensions)
+    return lambda f: f.lower().endswith(exts)
 
-def is_24bit(flac_dir):
-    '''
-    Returns True if any FLAC within flac_dir is 24 bit.
+def scan_flacs(flac_dir):
     '''
-    flacs = (mutagen.flac.FLAC(flac_file) for flac_file in locate(flac_dir, ext_matcher('.flac')))
-    return any(flac.info.bits_per_sample > 16 for flac in flacs)
+    Walks flac_dir once and parses each FLAC header exactly once.
 
-def is_multichannel(flac_dir):
-    '''
-    Returns True if any FLAC within flac_dir is multichannel.
-    '''
-    flacs = (mutagen.flac.FLAC(flac_file) for flac_file in locate(flac_dir, ext_matcher('.flac')))
-    return any(flac.info.channels > 2 for flac in flacs)
+    Returns a dict mapping each FLAC's path to a (sample_rate,
+    bits_per_sample, channels) tuple. Everything else that needs stream
+    info (resample detection, channel checks, transcode itself) should
+    derive it from this dict instead of re-reading the files.
 
-def needs_resampling(flac_dir):
-    '''
-    Returns True if any FLAC within flac_dir needs resampling when
-    transcoded.
+    The parses are I/O-bound (an open() plus a few small reads each),
+    so they are farmed out to a thread pool; the GIL is released during
+    the reads, which makes the scan roughly as parallel as the disk
+    allows.
     '''
-    return is_24bit(flac_dir)
-
-def resample_rate(flac_dir):
-    '''
-    Returns the rate to which the release should be resampled.
-    '''
-    flacs = (mutagen.flac.FLAC(flac_file) for flac_file in locate(flac_dir, ext_matcher('.flac')))
-    original_rate = max(flac.info.sample_rate for flac in flacs)
-    if original_rate % 44100 == 0:
-        return 44100
-    elif original_rate % 48000 == 0:
-        return 48000
-    else:
-        return None
+    flac_files = list(locate(flac_dir, ext_matcher('.flac')))
+    max_workers = min(32, multiprocessing.cpu_count() * 4)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        infos = executor.map(lambda f: mutagen.flac.FLAC(f).info, flac_files)
+        return {flac_file: (info.sample_rate, info.bits_per_sample, info.channels)
+                for (flac_file, info) in zip(flac_files, infos)}
 
 def transcode_commands(output_format, resample, needed_sample_rate, flac_file, transcode_file):
     '''
-    Return a list of transcode steps (one command per list element),
-    which can be used to create a transcode pipeline for flac_file ->
+    Return a list of transcode steps (one argv list per step), which
+    can be used to create a transcode pipeline for flac_file ->
     transcode_file using the specified output_format, plus any
-    resampling, if needed.
+    resampling, if needed. Building argv lists directly means no shell
+    quoting or re-parsing of the filenames.
     '''
+    opts = shlex.split(encoders[output_format]['opts'])
+
+    if output_format == 'FLAC' and resample:
+        return [['sox', flac_file, '-G', '-b', '16', transcode_file, 'rate', '-v', '-L', str(needed_sample_rate), 'dither']]
+
     if resample:
-        flac_decoder = 'sox {FLAC} -G -b 16 -t wav - rate -v -L {SAMPLERATE} dither'
+        flac_decoder = ['sox', flac_file, '-G', '-b', '16', '-t', 'wav', '-', 'rate', '-v', '-L', str(needed_sample_rate), 'dither']
     else:
-        flac_decoder = 'flac -dcs -- {FLAC}'
-
-    lame_encoder = 'lame -S {OPTS} - {FILE}'
-    flac_encoder = 'flac {OPTS} -o {FILE} -'
+        flac_decoder = ['flac', '-dcs', '--', flac_file]
 
-    transcoding_steps = [flac_decoder]
+    commands = [flac_decoder]
 
     if encoders[output_format]['enc'] == 'lame':
-        transcoding_steps.append(lame_encoder)
+        commands.append(['lame', '-S'] + opts + ['-', transcode_file])
     elif encoders[output_format]['enc'] == 'flac':
-        transcoding_steps.append(flac_encoder)
+        commands.append(['flac'] + opts + ['-o', transcode_file, '-'])
 
-    transcode_args = {
-        'FLAC' : pipes.quote(flac_file),
-        'FILE' : pipes.quote(transcode_file),
-        'OPTS' : encoders[output_format]['opts'],
-        'SAMPLERATE' : needed_sample_rate,
-    }
+    return commands
 
-    if output_format == 'FLAC' and resample:
-        commands = ['sox {FLAC} -G -b 16 {FILE} rate -v -L {SAMPLERATE} dither'.format(**transcode_args)]
+def make_lame_encoder(output_format, sample_rate, channels):
+    '''
+    Returns a lameenc.Encoder configured to match the lame CLI options
+    in encoders[output_format] ('-b N' becomes a CBR bit rate, '-V n'
+    becomes a VBR quality).
+
+    Note that lameenc cannot seek back over its output, so VBR streams
+    come out without the Xing/LAME header and report wrong durations;
+    transcode() therefore only routes CBR targets through the
+    in-process path.
+    '''
+    opts = encoders[output_format]['opts'].split()
+    encoder = lameenc.Encoder()
+    encoder.set_in_sample_rate(sample_rate)
+    encoder.set_channels(channels)
+    encoder.set_quality(2)  # same psymodel effort as lame -h
+    encoder.silence()       # same as lame -S
+    if '-b' in opts:
+        encoder.set_bit_rate(int(opts[opts.index('-b') + 1]))
+    if '-V' in opts:
+        encoder.set_vbr(4)  # vbr_mtrh, i.e. --vbr-new
+        encoder.set_vbr_quality(int(opts[opts.index('-V') + 1]))
+    return encoder
+
+def transcode_mp3_inprocess(flac_file, transcode_file, output_format, needed_sample_rate=None):
+    '''
+    Decodes flac_file with libsndfile and encodes it to MP3 with LAME,
+    all in-process. Avoids the two fork+execs and the PCM copy through
+    a kernel pipe that the flac | lame pipeline costs per file.
+
+    needed_sample_rate, if given, resamples with soxr (the same DSP as
+    sox's rate filter) before encoding.
+    '''
+    if needed_sample_rate:
+        # Decode and resample in float32 so libsoxr keeps its full
+        # precision (the source may be 24 bit), then dither and
+        # quantize down to the int16 LAME wants -- the same
+        # rate -v -L ... dither treatment the sox pipeline applies.
+        # The resampler wants the whole signal, so no streaming here.
+        (pcm, sample_rate) = soundfile.read(flac_file, dtype='float32')
+        if needed_sample_rate != sample_rate:
+            pcm = soxr.resample(pcm, sample_rate, needed_sample_rate, quality='VHQ')
+            sample_rate = needed_sample_rate
+        dither = numpy.random.uniform(-0.5, 0.5, pcm.shape)
+        pcm = numpy.clip(pcm * 32767 + dither, -32768, 32767).astype(numpy.int16)
+        channels = 1 if pcm.ndim == 1 else pcm.shape[1]
+        encoder = make_lame_encoder(output_format, sample_rate, channels)
+        with open(transcode_file, 'wb') as output:
+            output.write(encoder.encode(pcm.tobytes()))
+            output.write(encoder.flush())
     else:
-        commands = map(lambda cmd: cmd.format(**transcode_args), transcoding_steps)
-    return commands
+        # Stream the decode in 1M-frame blocks instead of holding the
+        # whole file in memory; each block goes straight from
+        # libsndfile's decode buffer into LAME.
+        with soundfile.SoundFile(flac_file) as flac:
+            encoder = make_lame_encoder(output_format, flac.samplerate, flac.channels)
+            with open(transcode_file, 'wb') as output:
+                for block in flac.blocks(blocksize=1_000_000, dtype='int16'):
+                    output.write(encoder.encode(block.tobytes()))
+                output.write(encoder.flush())
 
 # Pool.map() can't pickle lambdas, so we need a helper function.
 def pool_transcode(args):
     return transcode(*args)
 
-def transcode(flac_file, output_dir, output_format):
+def transcode(flac_file, output_dir, output_format, info=None):
     '''
     Transcodes a FLAC file into another format.
+
+    info, if given, is flac_file's (sample_rate, bits_per_sample,
+    channels) tuple from scan_flacs(); passing it skips re-parsing the
+    FLAC header here.
     '''
     # gather metadata from the flac file
-    flac_info = mutagen.flac.FLAC(flac_file)
-    sample_rate = flac_info.info.sample_rate
-    bits_per_sample = flac_info.info.bits_per_sample
+    if info is None:
+        parsed = mutagen.flac.FLAC(flac_file).info
+        info = (parsed.sample_rate, parsed.bits_per_sample, parsed.channels)
+    (sample_rate, bits_per_sample, channels) = info
     resample = sample_rate > 48000 or bits_per_sample > 16
 
     # if resampling isn't needed then needed_sample_rate will not be used.
@@ -185,12 +285,12 @@ def transcode(flac_file, output_dir, output_format):
         else:
             raise UnknownSampleRateException('FLAC file "{0}" has a sample rate {1}, which is not 88.2, 176.4, 96, or 192kHz but needs resampling, this is unsupported'.format(flac_file, sample_rate))
 
-    if flac_info.info.channels > 2:
+    if channels > 2:
         raise TranscodeDownmixException('FLAC file "{0}" has more than 2 channels, unsupported'.format(flac_file))
 
     # determine the new filename
     transcode_basename = os.path.splitext(os.path.basename(flac_file))[0]
-    transcode_basename = re.sub(r'[\?<>\\*\|"]', '_', transcode_basename)
+    transcode_basename = _SANITIZE_FILE.sub('_', transcode_basename)
     transcode_file = os.path.join(output_dir, transcode_basename)
     transcode_file += encoders[output_format]['ext']
 
@@ -205,23 +305,36 @@ def transcode(flac_file, output_dir, output_format):
             else:
                 raise e
 
-    commands = list(transcode_commands(output_format, resample, needed_sample_rate, flac_file, transcode_file))
-    results = run_pipeline(commands)
-
-    # Check for problems. Because it's a pipeline, the earliest one is
-    # usually the source. The exception is -SIGPIPE, which is caused
-    # by "backpressure" due to a later command failing: ignore those
-    # unless no other problem is found.
-    last_sigpipe = None
-    for (cmd, (code, stderr)) in zip(commands, results):
-        if code:
-            if code == -signal.SIGPIPE:
-                last_sigpipe = (cmd, (code, stderr))
-            else:
-                raise TranscodeException('Transcode of file "{0}" failed: {1}'.format(flac_file, stderr))
-    if last_sigpipe:
-        # XXX: this should probably never happen....
-        raise TranscodeException('Transcode of file "{0}" failed: SIGPIPE'.format(flac_file))
+    # in-process fast path, CBR targets only: lameenc streams and never
+    # seeks back to write the Xing/LAME header VBR files need for
+    # correct durations and seeking, so V0/V2 stay on the lame
+    # pipeline. Resampled files additionally need soxr.
+    if (lameenc is not None and encoders[output_format]['enc'] == 'lame'
+            and '-b' in encoders[output_format]['opts'].split()
+            and (not resample or soxr is not None)):
+        try:
+            transcode_mp3_inprocess(flac_file, transcode_file, output_format,
+                                    int(needed_sample_rate) if resample else None)
+        except Exception as e:
+            raise TranscodeException('Transcode of file "{0}" failed: {1}'.format(flac_file, e))
+    else:
+        commands = list(transcode_commands(output_format, resample, needed_sample_rate, flac_file, transcode_file))
+        results = run_pipeline(commands)
+
+        # Check for problems. Because it's a pipeline, the earliest one is
+        # usually the source. The exception is -SIGPIPE, which is caused
+        # by "backpressure" due to a later command failing: ignore those
+        # unless no other problem is found.
+        last_sigpipe = None
+        for (cmd, (code, stderr)) in zip(commands, results):
+            if code:
+                if code == -signal.SIGPIPE:
+                    last_sigpipe = (cmd, (code, stderr))
+                else:
+                    raise TranscodeException('Transcode of file "{0}" failed: {1}'.format(flac_file, stderr))
+        if last_sigpipe:
+            # XXX: this should probably never happen....
+            raise TranscodeException('Transcode of file "{0}" failed: SIGPIPE'.format(flac_file))
 
     tagging.copy_tags(flac_file, transcode_file)
     (ok, msg) = tagging.check_tags(transcode_file)
@@ -230,20 +343,16 @@ def transcode(flac_file, output_dir, output_format):
 
     return transcode_file
 
-def path_length_exceeds_limit(flac_dir, basename):
-    path_length = 0;
-    flac_files = locate(flac_dir, ext_matcher('.flac'))
-
-    source_directory_name = flac_dir[flac_dir.rfind('/') + 1:-1]
-
-    for root, dirs, files in os.walk(flac_dir):
-        for name in files:
-            if len(basename + root[root.rfind(source_directory_name) + len(source_directory_name) + 1:-1] + "/" + name) > 180:
-                    return True
-            else:
-                pathcheck = len(basename + root[root.rfind(source_directory_name) + len(source_directory_name) + 1:-1] + "/" + name)
-
-    return False
+def max_path_suffix_length(flac_dir):
+    '''
+    Returns the length of the longest file path inside flac_dir,
+    relative to flac_dir. Adding it (plus a separator) to a candidate
+    directory name gives the longest path the transcode will create.
+    '''
+    rel_paths = [os.path.relpath(os.path.join(root, name), flac_dir)
+                 for (root, dirs, files) in os.walk(flac_dir)
+                 for name in files]
+    return max((len(p) for p in rel_paths), default=0)
 
 def get_transcode_dir(flac_dir, output_dir, basename, output_format, resample):
     if output_format == "FLAC":
@@ -254,25 +363,43 @@ def get_transcode_dir(flac_dir, output_dir, basename, output_format, resample):
         basename += " [MP3-320]"
     else:
         basename += " [MP3-V2]"
-    
-    while path_length_exceeds_limit(flac_dir, basename):
+
+    # Walk the tree once; every candidate name after a rename only
+    # needs the arithmetic, not another walk.
+    max_suffix_len = max_path_suffix_length(flac_dir) + 1
+    while len(basename) + max_suffix_len > 180:
         basename = input("The file paths in this torrent exceed the 180 character limit. \n\
         The current directory name is: " + basename + " \n\
         Please enter a shorter directory name: ")
 
-    basename = basename.replace('\\', '').replace('/', '').replace(':', '').replace('*', '').replace('?', '').replace('"', '').replace('<', '').replace('>', '').replace('|', '')
+    basename = basename.translate(_SANITIZE_DIR)
     return os.path.join(output_dir, basename)
 
-def transcode_release(flac_dir, output_dir, basename, output_format, max_threads=None):
+def _output_dir_for(filename, flac_dir, transcode_dir):
+    '''
+    Maps the directory of a file under flac_dir to the matching
+    directory under transcode_dir. str.replace on the full path would
+    mis-rewrite if flac_dir's name reappears deeper in the tree.
+    '''
+    rel = os.path.relpath(os.path.dirname(filename), flac_dir)
+    return os.path.normpath(os.path.join(transcode_dir, rel))
+
+def transcode_release(flac_dir, output_dir, basename, output_format, max_threads=None, flac_info=None):
     '''
     Transcode a FLAC release into another format.
+
+    flac_info, if given, is the dict returned by scan_flacs(flac_dir);
+    passing it avoids re-scanning a release the caller already scanned.
     '''
     flac_dir = os.path.abspath(flac_dir)
     output_dir = os.path.abspath(output_dir)
-    flac_files = locate(flac_dir, ext_matcher('.flac'))
+    if flac_info is None:
+        flac_info = scan_flacs(flac_dir)
+    flac_files = flac_info.keys()
 
-    # check if we need to resample
-    resample = needs_resampling(flac_dir)
+    # check if we need to resample (any 24 bit file means the whole
+    # release is taken down to 16 bit)
+    resample = any(bits > 16 for (rate, bits, channels) in flac_info.values())
 
     # check if we need to encode
     if output_format == 'FLAC' and not resample:
@@ -314,35 +441,45 @@ def transcode_release(flac_dir, output_dir, basename, output_format, max_threads
         signal.signal(signal.SIGTERM, sigterm_handler)
 
     try:
-        # create transcoding threads
-        #
-        # Use Pool.map() rather than Pool.apply_async() as it will raise
-        # exceptions synchronously. (Don't want to waste any more time
-        # when a transcode breaks.)
+        # create transcoding processes
         #
-        # XXX: actually, use Pool.map_async() and then get() the result
-        # with a large timeout, as a workaround for a KeyboardInterrupt in
-        # Pool.join(). c.f.,
-        # http://stackoverflow.com/questions/1408356/keyboard-interrupts-with-pythons-multiprocessing-pool?rq=1
-        pool = multiprocessing.Pool(max_threads, initializer=pool_initializer)
+        # executor.map() raises the first worker exception while the
+        # results are being consumed. On failure, cancel whatever
+        # hasn't started and SIGTERM the worker processes; the
+        # pool_initializer handler then takes down each worker's
+        # process group, including any child flac/sox/lame pipelines,
+        # instead of letting in-flight chunks run to completion.
+        # Chunked submission cuts per-task IPC by the chunk factor.
+        workers = max_threads if max_threads else multiprocessing.cpu_count()
+        jobs = [(filename, _output_dir_for(filename, flac_dir, transcode_dir), output_format, flac_info[filename]) for filename in flac_files]
+        chunksize = max(1, len(jobs) // (4 * workers))
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=pool_initializer)
         try:
-            result = pool.map_async(pool_transcode, [(filename, os.path.dirname(filename).replace(flac_dir, transcode_dir), output_format) for filename in flac_files])
-            result.get(60 * 60 * 12)
-            pool.close()
+            for result in executor.map(pool_transcode, jobs, chunksize=chunksize):
+                pass
         except:
-            pool.terminate()
+            # grab the pids first; shutdown() drops its process table
+            pool_workers = list((executor._processes or {}).values())
+            executor.shutdown(wait=False, cancel_futures=True)
+            for worker in pool_workers:
+                worker.terminate()
             raise
         finally:
-            pool.join()
+            executor.shutdown()
 
         # copy other files
+        #
+        # Create all target directories in one pass, then copy.
+        # copyfile (rather than copy) takes the in-kernel os.sendfile
+        # path on Linux and skips the permission-copying stat dance,
+        # which we don't need for these files.
         allowed_extensions = ['.cue', '.gif', '.jpeg', '.jpg', '.log', '.md5', '.nfo', '.pdf', '.png', '.sfv', '.txt']
-        allowed_files = locate(flac_dir, ext_matcher(*allowed_extensions))
+        allowed_files = list(locate(flac_dir, ext_matcher(*allowed_extensions)))
+        target_dirs = {filename: _output_dir_for(filename, flac_dir, transcode_dir) for filename in allowed_files}
+        for new_dir in set(target_dirs.values()):
+            os.makedirs(new_dir, exist_ok=True)
         for filename in allowed_files:
-            new_dir = os.path.dirname(filename).replace(flac_dir, transcode_dir)
-            if not os.path.exists(new_dir):
-                os.makedirs(new_dir)
-            shutil.copy(filename, new_dir)
+            shutil.copyfile(filename, os.path.join(target_dirs[filename], os.path.basename(filename)))
 
         return transcode_dir
 
@@ -361,7 +498,7 @@ def main():
     """
     parser = argparse.ArgumentParser(description="hello")
     parser.add_argument('path', help="Path to the directory")
-    parser.add_argument('-t', '--threads', nargs='*', required=False, default=multiprocessing.cpu_count(), type=int, help="CPU Threads for transcoding")
+    parser.add_argument('-t', '--threads', required=False, default=multiprocessing.cpu_count(), type=int, help="CPU Threads for transcoding")
     args = parser.parse_args()
 
     # Ask the user which transcode format they need
@@ -371,24 +508,31 @@ def main():
     """
     Gather output folder naming information
     """
-    ArtistName = []
+    ArtistName = set()
     AlbumName = None
     Year = None
     bps = None
     basename = None
     flac_dir = os.path.abspath(args.path)
     output_dir = os.path.join(flac_dir, os.path.pardir)
-    flac_files = locate(flac_dir, ext_matcher('.flac'))
-    for flac_file in flac_files:
-        flac_info = mutagen.flac.FLAC(flac_file)
-        # print(flac_info.info.sample_rate)
-        AlbumName = flac_info.get("album", 'Unknown Album')[0]
-        ArtistName.append(flac_info.get("artist", 'Unknown Artist')[0])
-        Year = flac_info.get("year", '0000')[0]
-        bps = flac_info.info.bits_per_sample
+    # scan once; the same dict is handed to transcode_release so nothing
+    # downstream has to re-read the FLAC headers
+    flac_info = scan_flacs(flac_dir)
+    flac_files = list(flac_info)
+    if flac_files:
+        # album/year/bit depth are per-release, so the first file is
+        # enough for those; keep parsing further files only until we
+        # know whether this is a Various Artists release (3+ artists)
+        first_tags = mutagen.flac.FLAC(flac_files[0])
+        AlbumName = first_tags.get("album", 'Unknown Album')[0]
+        Year = first_tags.get("year", '0000')[0]
+        bps = flac_info[flac_files[0]][1]
+        ArtistName.add(first_tags.get("artist", 'Unknown Artist')[0])
+        for flac_file in flac_files[1:]:
+            if len(ArtistName) > 2:
+                break
+            ArtistName.add(mutagen.flac.FLAC(flac_file).get("artist", 'Unknown Artist')[0])
 
-    
-    ArtistName = set(ArtistName)
     if ArtistName:
         if len(ArtistName) < 2:
             ArtistName = list(ArtistName)[0]
@@ -413,9 +557,9 @@ def main():
     
         if type(output_format) == list:
             for i in range(len(output_format)):
-                transcode_release(flac_dir, output_dir, basename, output_format[i], max_threads=None)
+                transcode_release(flac_dir, output_dir, basename, output_format[i], max_threads=args.threads, flac_info=flac_info)
         else:
             pass
-            transcode_release(flac_dir, output_dir, basename, output_format, max_threads=None)
+            transcode_release(flac_dir, output_dir, basename, output_format, max_threads=args.threads, flac_info=flac_info)
 
 if __name__ == "__main__": main()